@@ -1,8 +1,14 @@
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Optional, NamedTuple
-from collections.abc import Generator, Iterator
+from collections.abc import Generator
 import numpy as np
 from libertem.common import Shape, Slice
+from libertem.common.buffers import empty_aligned
+from libertem.common.math import prod
 from libertem.common.executor import (
     TaskProtocol, WorkerQueue, TaskCommHandler, WorkerContext,
     JobCancelledError,
@@ -14,7 +20,9 @@ from sparseconverter import ArrayBackend, NUMPY, CUDA
 
 from libertem_live.detectors.base.acquisition import AcquisitionMixin
 from libertem_live.hooks import Hooks, ReadyForDataEnv
-from .data import MerlinRawFrames, MerlinFrameStream, AcquisitionHeader
+from .data import (
+    MerlinRawFrames, MerlinFrameStream, AcquisitionHeader, FrameHeader, get_decoder,
+)
 from .connection import MerlinDetectorConnection, MerlinPendingAcquisition
 from .controller import MerlinActiveController
 
@@ -25,6 +33,19 @@ tracer = trace.get_tracer(__name__)
 logger = logging.getLogger(__name__)
 
 
+# Number of frames per tile, unless the partitions are smaller:
+TILING_DEPTH = 24
+
+# Target size of the frame chunks that are read from the socket at once, and
+# sent as one queue message; this matches the slot size of LiberTEM's shared
+# memory queue:
+CHUNK_TARGET_BYTES = 2*1024*1024
+
+# Upper limit for the decode buffers that are kept on the workers between
+# partitions, see `_get_scratch`:
+SCRATCH_MAX_BYTES = 64*1024*1024
+
+
 class AcqState(NamedTuple):
     acq_header: AcquisitionHeader
     stream: MerlinFrameStream
@@ -117,6 +138,12 @@ class MerlinAcquisition(AcquisitionMixin, DataSet):
             raw_dtype=dtype,
             dtype=dtype,
         )
+        self._num_frames = prod(self._nav_shape)
+        self._sig_size = prod(sig_shape)
+        # tiles, and the decode buffers on the workers, are sized from this:
+        self._tiling_depth = min(TILING_DEPTH, self._frames_per_partition)
+        # one tile of float64 frames:
+        self._max_io_size = self._tiling_depth * self._sig_size * 8
         return self
 
     @property
@@ -176,23 +203,19 @@ class MerlinAcquisition(AcquisitionMixin, DataSet):
 
     def adjust_tileshape(self, tileshape, roi):
         ''
-        depth = 24
-        return (depth, *self.meta.shape.sig)
+        return (self._tiling_depth, *self.meta.shape.sig)
         # return Shape((self._end_idx - self._start_idx, 256, 256), sig_dims=2)
 
     def get_max_io_size(self):
         ''
-        # return 12*256*256*8
-        # FIXME magic numbers?
-        return 24*np.prod(self.meta.shape.sig)*8
+        return self._max_io_size
 
     def get_base_shape(self, roi):
         return (1, 1, self.meta.shape.sig[-1])
 
     def get_partitions(self):
         ''
-        num_frames = np.prod(self._nav_shape, dtype=np.uint64)
-        num_partitions = int(num_frames // self._frames_per_partition)
+        num_partitions = self._num_frames // self._frames_per_partition
 
         slices = BasePartition.make_slices(self.shape, num_partitions)
         for part_slice, start, stop in slices:
@@ -208,76 +231,257 @@ class MerlinAcquisition(AcquisitionMixin, DataSet):
         return MerlinCommHandler(
             conn=self._conn,
             state=self._acq_state,
-            tiling_depth=24,  # FIXME!
+            tiling_depth=self._tiling_depth,
         )
 
 
-def get_frames_from_queue(
+# State that is kept across partitions on the workers. It is per thread, as
+# executors can run multiple tasks concurrently in threads of one process:
+_worker_local = threading.local()
+
+
+def _get_decode_pool() -> ThreadPoolExecutor:
+    """
+    Thread pool for decoding frames in the background. The numba decoders
+    release the GIL, so decoding the next chunk of frames overlaps with
+    processing the current one.
+    """
+    decode_pool = getattr(_worker_local, "decode_pool", None)
+    # don't re-use a pool that was inherited via `fork`:
+    if decode_pool is None or decode_pool[0] != os.getpid():
+        decode_pool = _worker_local.decode_pool = (
+            os.getpid(),
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="MerlinDecode"),
+        )
+    return decode_pool[1]
+
+
+def _get_scratch(name: str, shape: tuple[int, ...], dtype) -> np.ndarray:
+    """
+    Get a page-aligned buffer that is re-used across partitions, instead of
+    allocating and zeroing a new one each time. The contents are undefined.
+
+    Only one buffer per `name` is kept, and it is replaced if the requested
+    size changes, so the memory held between acquisitions is bounded by the
+    last request. Buffers larger than `SCRATCH_MAX_BYTES` are not kept at all.
+    """
+    dtype = np.dtype(dtype)
+    size = prod(shape) * dtype.itemsize
+    scratch = _worker_local.__dict__.setdefault("scratch", {})
+    buf = scratch.pop(name, None)
+    if buf is None or buf.shape[0] != size:
+        buf = empty_aligned((size,), dtype=np.uint8)
+    if size <= SCRATCH_MAX_BYTES:
+        scratch[name] = buf
+    return buf.view(dtype).reshape(shape)
+
+
+def _iter_raw_frames(
     queue: WorkerQueue,
-    tiling_scheme: TilingScheme,
-    sig_shape: tuple[int, ...],
-    dtype
-) -> Generator[tuple[np.ndarray, int], None, None]:
-    out = np.zeros((tiling_scheme.depth,) + sig_shape, dtype=dtype)
-    out_flat = out.reshape((tiling_scheme.depth, -1,))
+    depth: int,
+) -> Generator[MerlinRawFrames, None, None]:
+    """
+    Yield chunks of at most `depth` raw frames from the messages on `queue`.
+    Messages are split at multiples of `depth` frames, counted from the first
+    frame of the partition, so no chunk crosses a tile boundary. The message
+    backing a chunk stays valid until the next chunk is requested.
+    """
+    first_frame_header: Optional[FrameHeader] = None
+    bytes_per_frame = 0
+    decoder = None
+    partition_start: Optional[int] = None
     while True:
         with queue.get() as msg:
             header, payload = msg
             header_type = header["type"]
-            if header_type == "FRAME":
-                raw_frames = MerlinRawFrames(
-                    buffer=payload,
-                    start_idx=header['start_idx'],
-                    end_idx=header['end_idx'],
-                    first_frame_header=header['first_frame_header'],
-                )
-                with tracer.start_as_current_span("MerlinRawFrames.decode") as span:
-                    span.set_attributes({
-                        "libertem_live.header.start_idx": header["start_idx"],
-                        "libertem_live.header.end_idx": header["end_idx"],
-                        "libertem_live.buffer.len": len(payload),
-                    })
-                    raw_frames.decode(
-                        out_flat=out_flat,
+            if header_type == "FRAMES":
+                start_idx = header["start_idx"]
+                end_idx = header["end_idx"]
+                assert first_frame_header is not None, "expected BEGIN_TASK before FRAMES"
+                if partition_start is None:
+                    partition_start = start_idx
+                # a chunk can be a multiple of the tiling depth, so the message
+                # can contain more frames than fit into `out`:
+                chunk_start = start_idx
+                while chunk_start < end_idx:
+                    tile_end = chunk_start + depth - (chunk_start - partition_start) % depth
+                    chunk_end = min(tile_end, end_idx)
+                    payload_offset = (chunk_start - start_idx) * bytes_per_frame
+                    yield MerlinRawFrames(
+                        buffer=payload[payload_offset:],
+                        start_idx=chunk_start,
+                        end_idx=chunk_end,
+                        first_frame_header=first_frame_header,
+                        decoder=decoder,
                     )
-                yield out[:raw_frames.num_frames], raw_frames.start_idx
+                    chunk_start = chunk_end
+            elif header_type == "BEGIN_TASK":
+                first_frame_header = FrameHeader.from_bytes(header["first_frame_header"])
+                bytes_per_frame = (
+                    first_frame_header.header_size_bytes + 15
+                    + first_frame_header.image_size_bytes
+                )
+                decoder = get_decoder(first_frame_header)
             elif header_type == "END_PARTITION":
                 # print(f"partition {partition} done")
                 return
             else:
                 raise RuntimeError(
-                    f"invalid header type {header['type']}; FRAME or END_PARTITION expected"
+                    f"invalid header type {header_type}; "
+                    f"BEGIN_TASK, FRAMES or END_PARTITION expected"
                 )
 
 
-def _accum_partition(
-    frames_iter: Iterator[tuple[np.ndarray, int]],
+def _decode_timed(raw_frames: MerlinRawFrames, out_flat: np.ndarray) -> float:
+    t0 = time.perf_counter()
+    raw_frames.decode(out_flat=out_flat)
+    return time.perf_counter() - t0
+
+
+def get_frames_from_queue(
+    queue: WorkerQueue,
     tiling_scheme: TilingScheme,
     sig_shape: tuple[int, ...],
-    dtype
-) -> np.ndarray:
+    dtype,
+    out: Optional[np.ndarray] = None,
+) -> Generator[tuple[np.ndarray, int], None, None]:
     """
-    Accumulate frame stacks for a partition
+    Decode the frames of a partition as they arrive on the `queue`, and yield
+    tuples `(frame_stack, start_idx)`.
+
+    By default, the frames are decoded alternately into two buffers of depth
+    `tiling_scheme.depth`, which are re-used for the yielded frame stacks.
+    Consecutive chunks from the queue are decoded into the same buffer until
+    it is full, so the frame stacks have the full tiling depth even if the
+    chunks are smaller; only the last stack of a partition, or one
+    interrupted by a gap in the frame indices, can be shorter. If `out` is
+    given, the frames are instead decoded consecutively into `out`, which
+    must be large enough to hold all frames of the partition, and a view
+    into `out` is yielded for each chunk.
+
+    While a frame stack is being processed by the caller, the next one is
+    already decoded in a background thread.
     """
-    out = np.zeros((tiling_scheme.depth,) + sig_shape, dtype=dtype)
+    depth = tiling_scheme.depth
+    reuse_out = out is None
+    if out is None:
+        # page-aligned, so each decoded frame starts on a cache line boundary
+        # if the frame size allows it:
+        out = _get_scratch("decode", (2, depth) + sig_shape, dtype=dtype)
+    else:
+        out = out[np.newaxis]
+    out_flat = out.reshape((out.shape[0], out.shape[1], -1,))
+    pool = _get_decode_pool()
+    raw_iter = _iter_raw_frames(queue, depth)
+    # the frame stack that is ready, to be yielded while the next decode job
+    # is running:
+    pending: Optional[tuple[np.ndarray, int]] = None
+    buf_idx = 0
     offset = 0
-    for frame_stack, _ in frames_iter:
-        out[offset:offset+frame_stack.shape[0]] = frame_stack
-        offset += frame_stack.shape[0]
-    assert offset == tiling_scheme.depth
-    return out
+    # number of frames already decoded into the current tile buffer, and the
+    # index of its first frame:
+    fill = 0
+    tile_start = 0
+    # instead of a span per chunk, we trace the whole partition and
+    # aggregate the per-chunk numbers:
+    span = tracer.start_span("get_frames_from_queue")
+    num_chunks = 0
+    frames_decoded = 0
+    decode_time = 0.0
+    try:
+        for raw_frames in raw_iter:
+            num_frames = raw_frames.num_frames
+            if fill > 0 and (
+                fill + num_frames > depth
+                or raw_frames.start_idx != tile_start + fill
+            ):
+                # the chunk doesn't continue the current tile, so we hand
+                # it out as-is:
+                pending = (out[buf_idx, :fill], tile_start)
+                buf_idx = (buf_idx + 1) % 2
+                fill = 0
+            if fill == 0:
+                tile_start = raw_frames.start_idx
+            future = pool.submit(
+                _decode_timed, raw_frames, out_flat[buf_idx, offset + fill:],
+            )
+            try:
+                if pending is not None:
+                    yield pending
+                    pending = None
+            finally:
+                # the input buffer must stay valid until the decode job is done:
+                wait([future])
+            decode_time += future.result()
+            num_chunks += 1
+            frames_decoded += num_frames
+            if reuse_out:
+                fill += num_frames
+                if fill == depth:
+                    pending = (out[buf_idx], tile_start)
+                    buf_idx = (buf_idx + 1) % 2
+                    fill = 0
+            else:
+                pending = (out[buf_idx, offset:offset + num_frames], raw_frames.start_idx)
+                offset += num_frames
+        if pending is not None:
+            yield pending
+        if fill > 0:
+            yield out[buf_idx, :fill], tile_start
+    finally:
+        raw_iter.close()
+        span.set_attributes({
+            "libertem_live.decode.num_chunks": num_chunks,
+            "libertem_live.decode.num_frames": frames_decoded,
+            "libertem_live.decode.seconds": decode_time,
+        })
+        span.end()
+
+
+def get_frame_chunk_size(
+    bytes_per_frame: int,
+    tiling_depth: int,
+    target_bytes: int = CHUNK_TARGET_BYTES,
+) -> int:
+    """
+    Determine how many frames to read from the socket at once, so that a chunk
+    is about `target_bytes` large. The result is either a divisor or a multiple
+    of `tiling_depth`, so chunks line up with the tiles they are decoded into.
+    """
+    max_frames = max(1, target_bytes // bytes_per_frame)
+    if max_frames >= tiling_depth:
+        return max_frames - max_frames % tiling_depth
+    for frame_chunk_size in range(max_frames, 0, -1):
+        if tiling_depth % frame_chunk_size == 0:
+            return frame_chunk_size
+    return 1
 
 
 class MerlinCommHandler(TaskCommHandler):
+    """
+    Parameters
+    ----------
+    frame_chunk_size
+        Number of frames to read from the socket at once, which are then sent
+        to the worker as one queue message. By default, this is derived from
+        the frame size, see :func:`get_frame_chunk_size`.
+    """
     def __init__(
         self,
         conn: MerlinDetectorConnection,
         state: AcqState,
-        tiling_depth: int
+        tiling_depth: int,
+        frame_chunk_size: Optional[int] = None,
     ):
         self._conn = conn
         self._acq_state = state
         self._tiling_depth = tiling_depth
+        if frame_chunk_size is None:
+            frame_chunk_size = get_frame_chunk_size(
+                bytes_per_frame=state.stream.get_read_size(1),
+                tiling_depth=tiling_depth,
+            )
+        self._frame_chunk_size = frame_chunk_size
 
     def handle_task(self, task: TaskProtocol, queue: WorkerQueue):
         with tracer.start_as_current_span("MerlinCommHandler.handle_task") as span:
@@ -288,39 +492,52 @@ class MerlinCommHandler(TaskCommHandler):
                 "libertem.partition.start_idx": start_idx,
                 "libertem.partition.end_idx": end_idx,
             })
-            frame_chunk_size = min(32, self._tiling_depth)
+            frame_chunk_size = self._frame_chunk_size
             frames_read = 0
             num_frames_in_partition = end_idx - start_idx
             stream = self._acq_state.stream
+            # the first frame header stays the same for all `FRAMES` messages
+            # of the task, so we only send it once:
+            queue.put({
+                "type": "BEGIN_TASK",
+                "first_frame_header": stream.get_first_frame_header().to_bytes(),
+            })
             while frames_read < num_frames_in_partition:
                 next_read_size = min(
                     num_frames_in_partition - frames_read,
                     frame_chunk_size,
                 )
-                # FIXME: can't properly reuse this buffer currently...
-                input_buffer = stream.get_input_buffer(next_read_size)
-                res = stream.read_multi_frames(
-                    input_buffer=input_buffer,
-                    num_frames=next_read_size,
-                    read_upto_frame=end_idx,
-                )
-                if res is False:
+                # We read directly into the payload buffer of the queue,
+                # instead of into a separate buffer that is then passed to
+                # `queue.put`. Whether this saves an allocation or a copy
+                # depends on the queue: the `SimpleMPWorkerQueue` used by the
+                # pipelined executor still allocates and pickles the payload.
+                # The message header is only known after reading, so we fill
+                # it in before the message is sent at the end of the block.
+                # If we didn't get any data, we leave the block with an
+                # exception, which discards the message without sending it:
+                header: dict = {"type": "FRAMES"}
+                try:
+                    with queue.put_nocopy(
+                        header, size=stream.get_read_size(next_read_size)
+                    ) as input_buffer:
+                        res = stream.read_multi_frames(
+                            input_buffer=input_buffer,
+                            num_frames=next_read_size,
+                            read_upto_frame=end_idx,
+                        )
+                        if res is False:
+                            raise JobCancelledError("timeout while handling task")
+                        if res is True:
+                            raise JobCancelledError("expected more data, didn't get any")
+                        header["start_idx"] = res.start_idx
+                        header["end_idx"] = res.end_idx
+                except JobCancelledError:
                     queue.put({
                         "type": "END_PARTITION",
                     })
-                    raise JobCancelledError("timeout while handling task")
-                if res is True:
-                    queue.put({
-                        "type": "END_PARTITION",
-                    })
-                    raise JobCancelledError("expected more data, didn't get any")
+                    raise
                 frames_read += res.num_frames
-                queue.put({
-                    "type": "FRAME",
-                    "start_idx": res.start_idx,
-                    "end_idx": res.end_idx,
-                    "first_frame_header": res.first_frame_header,
-                }, payload=np.frombuffer(res.buffer, dtype=np.uint8))
             # FIXME: END_PARTITION in finally block?
             queue.put({
                 "type": "END_PARTITION",
@@ -366,22 +583,22 @@ class MerlinLivePartition(Partition):
         logger.debug("reading up to frame idx %d for this partition", self._end_idx)
 
         queue = self._worker_context.get_worker_queue()
-        frames = get_frames_from_queue(
-            queue,
-            tiling_scheme,
-            self.shape.sig.to_tuple(),
-            dtype=dest_dtype
-        )
+        sig_shape = self.shape.sig.to_tuple()
 
-        # special case: copy from the decode buffer into a larger partition buffer
-        # can be further optimized if needed (by directly decoding into said buffer)
+        # special case: decode directly into a buffer for the whole partition
         if tiling_scheme.intent == "partition":
-            frame_stack = _accum_partition(
-                frames,
-                tiling_scheme,
-                self.shape.sig.to_tuple(),
-                dtype=dest_dtype
+            # The tile is passed to the UDF as-is, so it needs its own buffer
+            # that isn't overwritten by the next partition. It's not zeroed,
+            # as all frames are decoded into it:
+            frame_stack = empty_aligned(
+                (tiling_scheme.depth,) + sig_shape, dtype=dest_dtype,
             )
+            num_frames = 0
+            for frames, _ in get_frames_from_queue(
+                queue, tiling_scheme, sig_shape, dtype=dest_dtype, out=frame_stack,
+            ):
+                num_frames += frames.shape[0]
+            assert num_frames == tiling_scheme.depth
             tile_shape = Shape(
                 frame_stack.shape,
                 sig_dims=2
@@ -397,6 +614,12 @@ class MerlinLivePartition(Partition):
             )
             return
 
+        frames = get_frames_from_queue(
+            queue,
+            tiling_scheme,
+            sig_shape,
+            dtype=dest_dtype
+        )
         for frame_stack, start_idx in frames:
             tile_shape = Shape(
                 frame_stack.shape,
@@ -1,14 +1,19 @@
 import logging
+import selectors
 import socket
+import struct
+import threading
 import time
 from typing import (
-    Optional, NamedTuple
+    Callable, Optional, NamedTuple, Union,
 )
 from collections.abc import Generator
 
 import numpy as np
+from libertem.common.buffers import bytes_aligned, zeros_aligned
 
 from libertem_live.detectors.base.acquisition import AcquisitionTimeout
+from libertem_live.detectors.common import ErrThreadMixin, set_thread_name
 from .decoders import (
     decode_multi_u1,
     decode_multi_u2,
@@ -71,6 +76,12 @@ def get_np_dtype(dtype, bit_depth) -> np.dtype:
         raise NotImplementedError(f"unknown dtype prefix: {dtype[0]}")
 
 
+# Fixed binary layout of `FrameHeader`, for passing it along with frame data:
+# header_size_bytes, mib_dtype, bits_per_pixel, image_size, image_size_eff,
+# image_size_bytes, sequence_first_image, num_chips
+FRAME_HEADER_STRUCT = struct.Struct("<q4sB2q2qqqH")
+
+
 class FrameHeader(NamedTuple):
     header_size_bytes: int
     dtype: np.dtype
@@ -137,6 +148,43 @@ class FrameHeader(NamedTuple):
             num_chips=num_chips,
         )
 
+    def to_bytes(self) -> bytes:
+        """
+        Serialize into a fixed-size binary representation, see
+        :meth:`from_bytes` for the reverse.
+        """
+        return FRAME_HEADER_STRUCT.pack(
+            self.header_size_bytes,
+            self.mib_dtype.encode("ascii"),
+            self.bits_per_pixel,
+            *self.image_size,
+            *self.image_size_eff,
+            self.image_size_bytes,
+            self.sequence_first_image,
+            self.num_chips,
+        )
+
+    @classmethod
+    def from_bytes(cls, raw_data) -> "FrameHeader":
+        (
+            header_size_bytes, mib_dtype, bits_per_pixel,
+            height, width, height_eff, width_eff,
+            image_size_bytes, sequence_first_image, num_chips,
+        ) = FRAME_HEADER_STRUCT.unpack_from(raw_data)
+        mib_dtype = mib_dtype.rstrip(b"\0").decode("ascii")
+        return FrameHeader(
+            header_size_bytes=header_size_bytes,
+            dtype=get_np_dtype(mib_dtype, bits_per_pixel),
+            mib_dtype=mib_dtype,
+            mib_kind=mib_dtype[0],
+            bits_per_pixel=bits_per_pixel,
+            image_size=(height, width),
+            image_size_eff=(height_eff, width_eff),
+            image_size_bytes=image_size_bytes,
+            sequence_first_image=sequence_first_image,
+            num_chips=num_chips,
+        )
+
 
 def validate_get_sig_shape(frame_hdr, sig_shape=None):
     image_size = frame_hdr.image_size_eff
@@ -156,6 +204,48 @@ def validate_get_sig_shape(frame_hdr, sig_shape=None):
         return sig_shape
 
 
+def get_decoder(fh: FrameHeader) -> Callable:
+    """
+    Get the decoder function for frames described by the frame header `fh`.
+    The result only depends on the format of the frames, so it can be
+    resolved once and re-used for all frames of an acquisition.
+    """
+    itemsize = fh.dtype.itemsize
+    bits_pp = fh.bits_per_pixel
+    if fh.mib_kind == 'u':
+        # binary:
+        if itemsize == 1:
+            return decode_multi_u1
+        elif itemsize == 2:
+            return decode_multi_u2
+        else:
+            raise RuntimeError("itemsize %d currently not supported" % itemsize)
+    else:
+        # raw binary:
+        if fh.num_chips == 4:
+            if bits_pp == 1:
+                return decode_quad_r1
+            elif bits_pp == 6:
+                return decode_quad_r6
+            elif bits_pp == 12:
+                return decode_quad_r12
+            else:
+                raise RuntimeError(
+                    "can't handle quad raw binary %d bits per pixel yet" % bits_pp
+                )
+        elif fh.num_chips == 1:
+            if bits_pp == 1:
+                return decode_multi_r1
+            elif bits_pp == 6:
+                return decode_multi_r6
+            elif bits_pp == 12:
+                return decode_multi_r12
+            else:
+                raise RuntimeError("can't handle raw binary %d bits per pixel yet" % bits_pp)
+        else:
+            raise RuntimeError(f"Can't handle num_chips={fh.num_chips}")
+
+
 class MerlinRawFrames:
     def __init__(
         self,
@@ -163,11 +253,14 @@ class MerlinRawFrames:
         start_idx: int,
         end_idx: int,
         first_frame_header: FrameHeader,
+        decoder: Optional[Callable] = None,
     ):
         self._buffer = buffer
         self._start_idx = start_idx
         self._end_idx = end_idx
         self._first_frame_header = first_frame_header
+        # optional, pre-resolved result of `get_decoder(first_frame_header)`:
+        self._decoder = decoder
 
     @property
     def num_frames(self):
@@ -192,45 +285,19 @@ class MerlinRawFrames:
     def decode(self, out_flat: np.ndarray):
         fh = self._first_frame_header
         header_size = int(fh.header_size_bytes) + 15
-        itemsize = fh.dtype.itemsize
-        bits_pp = fh.bits_per_pixel
         num_rows = fh.image_size[0]
-        if fh.mib_kind == 'u':
-            # binary:
-            if itemsize == 1:
-                fn = decode_multi_u1
-            elif itemsize == 2:
-                fn = decode_multi_u2
-            else:
-                raise RuntimeError("itemsize %d currently not supported" % itemsize)
-        else:
-            # raw binary:
-            if fh.num_chips == 4:
-                if bits_pp == 1:
-                    fn = decode_quad_r1
-                elif bits_pp == 6:
-                    fn = decode_quad_r6
-                elif bits_pp == 12:
-                    fn = decode_quad_r12
-                else:
-                    raise RuntimeError(
-                        "can't handle quad raw binary %d bits per pixel yet" % bits_pp
-                    )
-            elif fh.num_chips == 1:
-                if bits_pp == 1:
-                    fn = decode_multi_r1
-                elif bits_pp == 6:
-                    fn = decode_multi_r6
-                elif bits_pp == 12:
-                    fn = decode_multi_r12
-                else:
-                    raise RuntimeError("can't handle raw binary %d bits per pixel yet" % bits_pp)
-            else:
-                raise RuntimeError(f"Can't handle num_chips={fh.num_chips}")
+        fn = self._decoder
+        if fn is None:
+            fn = get_decoder(fh)
         num_frames = self.num_frames
+        bytes_per_frame = header_size + fh.image_size_bytes
         compat_shape = (num_frames, num_rows, -1)
-        input_arr = np.frombuffer(self._buffer, dtype=np.uint8).reshape(
-            (num_frames, -1)
+        # the buffer can be larger than the data it contains, so we
+        # explicitly only look at the first `num_frames` frames:
+        input_arr = np.frombuffer(
+            self._buffer, dtype=np.uint8, count=num_frames * bytes_per_frame,
+        ).reshape(
+            (num_frames, bytes_per_frame)
         )[:, header_size:].reshape(compat_shape)
         out = out_flat[:num_frames].reshape(compat_shape)
         fn(input_arr, out, header_size, num_frames)
@@ -298,6 +365,7 @@ class MerlinRawSocket:
         self._port = port
         self._timeout = timeout
         self._socket = None
+        self._selector: Optional[selectors.BaseSelector] = None
         self._is_connected = False
         self._frame_counter = 0
 
@@ -306,12 +374,23 @@ class MerlinRawSocket:
         self._socket.connect((self._host, self._port))
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._socket.settimeout(self._timeout)
+        # unlike `select.select`, this is not limited to fds below FD_SETSIZE:
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
         self._is_connected = True
         return self
 
     def is_connected(self):
         return self._is_connected
 
+    def _wait_readable(self, timeout: Optional[float]) -> bool:
+        """
+        Wait for at most `timeout` seconds for data (or EOF) to be available
+        on the socket; returns `False` on timeout.
+        """
+        assert self._selector is not None
+        return len(self._selector.select(timeout)) > 0
+
     def read_unbuffered(self, length, cancel_timeout=None):
         """
         read exactly length bytes from the socket
@@ -322,12 +401,19 @@ class MerlinRawSocket:
             raise RuntimeError("can't read without connection")
         assert self._socket is not None
         total_bytes_read = 0
-        buf = bytearray(16*1024*1024)
-        assert length < len(buf)
+        # only allocate what we actually need - this is called for small
+        # reads like the MPX prefix, possibly in a polling loop:
+        buf = bytearray(length)
         view = memoryview(buf)
         start_time = time.time()
         while total_bytes_read < length:
-            try:
+            wait_timeout = self._timeout
+            if cancel_timeout is not None:
+                remaining = max(0, cancel_timeout - (time.time() - start_time))
+                if wait_timeout is None or remaining < wait_timeout:
+                    wait_timeout = remaining
+            # wait for data instead of polling via `socket.timeout` exceptions:
+            if self._wait_readable(wait_timeout):
                 bytes_read = self._socket.recv_into(
                     view[total_bytes_read:],
                     length - total_bytes_read
@@ -335,15 +421,17 @@ class MerlinRawSocket:
                 if bytes_read == 0:
                     raise EOFError("EOF")
                 total_bytes_read += bytes_read
-            except socket.timeout:
-                pass
             if cancel_timeout is not None and time.time() - start_time > cancel_timeout:
                 raise AcquisitionTimeout(f"Timeout after reading {total_bytes_read} bytes.")
-        return buf[:total_bytes_read]
+        return buf
 
-    def read_into(self, out):
+    def read_into(self, out, cancel: Optional[Callable[[], bool]] = None):
         """
         read exactly len(out) bytes from the socket
+
+        If `cancel` is given, we wait for data in short intervals and stop
+        reading as soon as `cancel()` returns `True`, even if the socket is
+        idle and has no timeout set. Returns the number of bytes read.
         """
         if not self.is_connected():
             raise RuntimeError("can't read without connection")
@@ -352,6 +440,13 @@ class MerlinRawSocket:
         total_bytes_read = 0
         view = memoryview(out)
         while total_bytes_read < length:
+            if cancel is not None:
+                t0 = time.time()
+                while not self._wait_readable(0.1):
+                    if cancel():
+                        return total_bytes_read
+                    if self._timeout is not None and time.time() - t0 > self._timeout:
+                        return total_bytes_read
             try:
                 bytes_read = self._socket.recv_into(
                     view[total_bytes_read:],
@@ -386,32 +481,44 @@ class MerlinRawSocket:
         self._acquisition_header = header
         return header
 
+    def _peek(self, length: int) -> bytes:
+        """
+        Peek exactly `length` bytes, without consuming them from the socket
+        """
+        assert self._socket is not None
+        buf = b''
+        while len(buf) < length:
+            if buf:
+                # the socket stays readable after a short peek, so waiting
+                # for it would return immediately; back off a bit instead
+                # of spinning until the rest has arrived:
+                time.sleep(0.001)
+            elif not self._wait_readable(self._timeout):
+                continue
+            # need to repeat, as a peek can give us less than what is
+            # requested, if the rest of the message hasn't arrived yet:
+            buf = self._socket.recv(length, socket.MSG_PEEK)
+            if len(buf) == 0:
+                raise EOFError("EOF")
+        return buf
+
     def peek_frame_header(self) -> FrameHeader:
         # first, peek only the MPX header part:
-        assert self._socket is not None
-        while True:
-            try:
-                buf = self._socket.recv(15, socket.MSG_PEEK)
-                assert len(buf) == 15
-                break
-            except socket.timeout:
-                pass
-        assert len(buf) == 15
+        buf = self._peek(15)
         parts = buf.split(b',')
         length = int(parts[1])
 
         # now, peek enough to read the frame header:
-        buf = b''
-        peek_length = min(15 + length, 4096)
-        while len(buf) < peek_length:
-            # need to repeat, as the first peek can fail to give the full length message:
-            buf = self._socket.recv(peek_length, socket.MSG_PEEK)
+        buf = self._peek(min(15 + length, 4096))
         frame_header = FrameHeader.from_raw(buf[15:])
         return frame_header
 
     def close(self):
         if self._is_connected:
             assert self._socket is not None
+            assert self._selector is not None
+            self._selector.close()
+            self._selector = None
             self._socket.close()
             self._socket = None
             self._is_connected = False
@@ -424,22 +531,21 @@ class MerlinRawSocket:
 
     def drain(self):
         """
-        read data from the data socket until we hit the timeout; returns
+        read data from the data socket until we hit the timeout or EOF; returns
         the number of bytes drained
         """
         assert self._socket is not None
         bytes_read = 0
-        # read from the socket until we hit the timeout:
-        old_timeout = self._socket.gettimeout()
-        self._socket.settimeout(0.1)
-        try:
-            while True:
-                data = self._socket.recv(4096)
-                bytes_read += len(data)
-        except socket.timeout:
-            return bytes_read
-        finally:
-            self._socket.settimeout(old_timeout)
+        # the data is discarded, so we can receive it in large pieces
+        # into a single scratch buffer:
+        buf = bytearray(1024*1024)
+        # read from the socket until we hit the timeout, or EOF:
+        while self._wait_readable(0.1):
+            chunk_size = self._socket.recv_into(buf)
+            if chunk_size == 0:
+                break
+            bytes_read += chunk_size
+        return bytes_read
 
 
 class MerlinFrameStream:
@@ -474,18 +580,28 @@ class MerlinFrameStream:
             first_frame_header=first_frame_header,
         )
 
-    def read_multi_frames(self, input_buffer, num_frames=32, read_upto_frame=None):
+    def read_multi_frames(
+        self, input_buffer, num_frames=32, read_upto_frame=None,
+        cancel: Optional[Callable[[], bool]] = None,
+    ):
         """
         Returns `False` on timeout, `True` in case we are done and don't need to
         read any more frames (according to `read_upto_frame`), or a
         `MerlinRawFrames` object
 
+        The frames are received directly into `input_buffer`, which needs to
+        be at least :meth:`get_read_size` bytes large for `num_frames`
+        frames; the returned `MerlinRawFrames` object references it.
+
         On EOF or timeout, can read less than `num_frames`. In that case, `buffer` is sliced
         to only contain decoded data. `out` will not be fully overwritten in this case
         and can contain garbage at the end.
 
         `read_upto_frame` can be used to only read up to a total number of frames.
         Once this number is reached, we behave the same way as if we had reached EOF.
+
+        `cancel` is passed on to :meth:`MerlinRawSocket.read_into`, to be able
+        to interrupt waiting for data.
         """
         assert self._first_frame_header is not None
         header_size = int(self._first_frame_header.header_size_bytes) + 15
@@ -497,7 +613,7 @@ class MerlinFrameStream:
             input_buffer = input_buffer[:num_frames * bytes_per_frame]
             if num_frames == 0:
                 return True  # we are done.
-        bytes_read = self._raw_socket.read_into(input_buffer)
+        bytes_read = self._raw_socket.read_into(input_buffer, cancel=cancel)
         frames_read = bytes_read // bytes_per_frame
         if bytes_read % bytes_per_frame != 0:
             raise EOFError(
@@ -522,18 +638,146 @@ class MerlinFrameStream:
             self._first_frame_header,
         )
 
-    def get_input_buffer(self, num_frames: int) -> bytearray:
+    def get_read_size(self, num_frames: int) -> int:
+        """
+        Size in bytes of `num_frames` frames, including their headers
+        """
         assert self._first_frame_header is not None
         header_size = int(self._first_frame_header.header_size_bytes) + 15
         image_size = int(self._first_frame_header.image_size_bytes)
-        read_size = num_frames*(header_size + image_size)
-        input_bytes = bytearray(read_size)
-        return input_bytes
+        return num_frames*(header_size + image_size)
 
     def get_first_frame_header(self) -> FrameHeader:
         return self._first_frame_header
 
 
+class MerlinFrameRing(ErrThreadMixin, threading.Thread):
+    """
+    Read stacks of frames from a `MerlinFrameStream` in a background thread,
+    into a ring of `num_slots` preallocated input buffers. This way, reading
+    from the socket overlaps with decoding.
+
+    There is exactly one producer (this thread) and one consumer; `_tail` is
+    only advanced by the producer and `_head` only by the consumer, so the
+    condition variable is only needed for waking up the other side when it
+    is idle.
+    """
+    def __init__(
+        self,
+        stream: MerlinFrameStream,
+        num_slots: int,
+        chunk_size: int,
+        num_frames: Optional[int] = None,
+        *args, **kwargs
+    ):
+        super().__init__(*args, daemon=True, **kwargs)
+        assert num_slots > 0
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._num_frames = num_frames
+        self._num_slots = num_slots
+        # each slot is separately page-aligned, so the slot being written by
+        # the producer never shares a cache line with one that is being
+        # read by the consumer:
+        self._slots = [
+            bytes_aligned(stream.get_read_size(num_frames=chunk_size))
+            for _ in range(num_slots)
+        ]
+        self._results: list = [None] * num_slots
+        self._head = 0  # next slot to be consumed
+        self._tail = 0  # next slot to be filled
+        self._cond = threading.Condition()
+
+    def _wait(self, predicate):
+        with self._cond:
+            while not predicate():
+                self._cond.wait(timeout=0.1)
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify()
+
+    def _read_chunk(self, buf) -> Union[MerlinRawFrames, bool]:
+        """
+        Read up to `chunk_size` frames into `buf`. The frames are read one at
+        a time, so that a stopped ring leaves the socket at a frame boundary,
+        and doesn't read more than the frame that is currently in flight.
+        Waiting for data is interrupted by :meth:`stop`, also if the socket
+        has no timeout.
+        """
+        bytes_per_frame = self._stream.get_read_size(num_frames=1)
+        view = memoryview(buf)
+        start_idx = None
+        end_idx = None
+        for i in range(self._chunk_size):
+            if self.is_stopped():
+                break
+            res = self._stream.read_multi_frames(
+                input_buffer=view[i * bytes_per_frame:(i + 1) * bytes_per_frame],
+                num_frames=1,
+                read_upto_frame=self._num_frames,
+                cancel=self.is_stopped,
+            )
+            if res is True or res is False:
+                if start_idx is None:
+                    return res
+                break
+            if start_idx is None:
+                start_idx = res.start_idx
+            end_idx = res.end_idx
+        if start_idx is None:
+            # stopped before reading anything:
+            return False
+        assert end_idx is not None
+        return MerlinRawFrames(
+            view[:(end_idx - start_idx) * bytes_per_frame],
+            start_idx,
+            end_idx,
+            self._stream.get_first_frame_header(),
+        )
+
+    def run(self):
+        set_thread_name('MerlinFrameRing')
+        try:
+            while not self.is_stopped():
+                self._wait(
+                    lambda: self._tail - self._head < self._num_slots or self.is_stopped()
+                )
+                if self.is_stopped():
+                    break
+                idx = self._tail % self._num_slots
+                res = self._read_chunk(self._slots[idx])
+                self._results[idx] = res
+                self._tail += 1
+                self._notify()
+                if res is True or res is False:
+                    break
+        except Exception as e:
+            if not self.is_stopped():
+                self.error(e)
+            self._notify()
+
+    def get(self) -> Union[MerlinRawFrames, bool]:
+        """
+        Get the next filled slot; this is either a `MerlinRawFrames` object,
+        or `True` / `False` at the end of the stream, see
+        :meth:`MerlinFrameStream.read_multi_frames`.
+
+        Call :meth:`release` once done with the result.
+        """
+        self._wait(
+            lambda: self._head < self._tail or self.get_error() is not None
+        )
+        if self._head == self._tail:
+            self.maybe_raise()
+        return self._results[self._head % self._num_slots]
+
+    def release(self):
+        self._results[self._head % self._num_slots] = None
+        self._head += 1
+        self._notify()
+
+
 class MerlinDataSource:
     def __init__(
         self,
@@ -544,6 +788,7 @@ class MerlinDataSource:
         timeout: Optional[float] = None
     ):
         self._sig_shape = sig_shape
+        self._pool_size = pool_size
         self.socket = MerlinRawSocket(
             host=host,
             port=port,
@@ -580,23 +825,45 @@ class MerlinDataSource:
         logger.info(frame_hdr)
 
         sig_shape = validate_get_sig_shape(frame_hdr, self._sig_shape)
-        out = np.zeros((chunk_size,) + sig_shape, dtype=read_dtype)
-        input_buffer = stream.get_input_buffer(num_frames=chunk_size)
-
-        while True:
-            res = stream.read_multi_frames(
-                num_frames=chunk_size,
-                input_buffer=input_buffer,
-                read_upto_frame=num_frames,
-            )
-            if not res:
-                break
-            if res is True:
-                break
-            yield MerlinDecodedFrames.from_raw(res, out)
+        out = zeros_aligned((chunk_size,) + sig_shape, dtype=read_dtype)
+        ring = MerlinFrameRing(
+            stream=stream,
+            num_slots=self._pool_size,
+            chunk_size=chunk_size,
+            num_frames=num_frames,
+        )
+        ring.start()
+        try:
+            while True:
+                res = ring.get()
+                if not res:
+                    break
+                if res is True:
+                    break
+                decoded = MerlinDecodedFrames.from_raw(res, out)
+                # the input buffer can be re-filled while the result is consumed:
+                ring.release()
+                yield decoded
+        finally:
+            # the reader thread must be gone before anyone else touches the
+            # socket; it stops after the frame it is currently reading, or
+            # right away if it is waiting for data:
+            ring.stop()
+            ring.join()
 
     def stream(self, num_frames=None, chunk_size=11, read_dtype=np.float32):
         """
+        Read and decode frames from the data socket, yielding
+        `MerlinDecodedFrames` of up to `chunk_size` frames.
+
+        Notes
+        -----
+
+        The socket is read ahead in a background thread by up to
+        :code:`pool_size` chunks. If you stop consuming early, for example
+        with :code:`break`, the frames that were read ahead are discarded and
+        can't be received by a subsequent call.
+
         Examples
         --------
 
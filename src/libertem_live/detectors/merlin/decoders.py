@@ -46,11 +46,13 @@ def decode_r1(inp, out):
         row_in = inp[y]
 
         for stripe in range(inp.shape[1] // 8):
+            # the 8 bytes of a stripe form a big endian 64bit word, with
+            # the first pixel in the least significant bit:
+            word = numba.uint64(0)
             for byte in range(8):
-                inp_byte = row_in[(stripe + 1) * 8 - (byte + 1)]
-                for bitpos in range(8):
-                    outpos = 64 * stripe + 8 * byte + bitpos
-                    row_out[outpos] = (inp_byte >> bitpos) & 1
+                word = (word << numba.uint64(8)) | numba.uint64(row_in[stripe * 8 + byte])
+            for bitpos in range(64):
+                row_out[64 * stripe + bitpos] = (word >> numba.uint64(bitpos)) & numba.uint64(1)
 
 
 @numba.njit(nogil=True, cache=True, parallel=False)
@@ -235,6 +235,19 @@ def merlin_detector_memfd(merlin_detector_memfd_threads):
     return merlin_detector_memfd_threads.server_t.sockname
 
 
+FRAME_HEADER_RAW = r"""MQ1,000001,00384,01,0256,0256,U08,   1x1,01,2020-05-18 16:51:49.971626,0.000555,0,0,0,1.200000E+2,5.110000E+2,0.000000E+0,0.000000E+0,0.000000E+0,0.000000E+0,0.000000E+0,0.000000E+0,3RX,175,511,000,000,000,000,000,000,125,255,125,125,100,100,082,100,087,030,128,004,255,129,128,176,168,511,511,MQ1A,2020-05-18T14:51:49.971626178Z,555000ns,6
+"""  # noqa
+
+
+@pytest.fixture
+def frame_header_raw():
+    '''
+    Raw header of a 256x256 frame with 6 bit counter depth, as sent
+    by the detector
+    '''
+    return FRAME_HEADER_RAW
+
+
 def get_header_string(num_frames, counter_depth):
     return fr"""HDR,
 Counter Depth (number):	{counter_depth}
@@ -0,0 +1,437 @@
+import io
+import socket
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from libertem.common import Shape, Slice
+from libertem.common.executor import SimpleWorkerQueue, JobCancelledError
+from libertem.io.dataset.base import DataSetMeta, TilingScheme
+from libertem.executor.pipelined import _drain_after_task
+
+from libertem_live.detectors.merlin.data import (
+    FrameHeader, MerlinFrameStream, MerlinFrameRing, MerlinRawSocket,
+)
+from libertem_live.detectors.merlin import acquisition
+from libertem_live.detectors.merlin.acquisition import (
+    AcqState, MerlinCommHandler, MerlinLivePartition, get_frames_from_queue,
+    get_frame_chunk_size, CHUNK_TARGET_BYTES,
+)
+
+
+SIG_SHAPE = (256, 256)
+
+
+class BytesRawSocket:
+    """
+    Stand-in for `MerlinRawSocket` that reads from an in-memory buffer
+    """
+    def __init__(self, data: bytes):
+        self._f = io.BytesIO(data)
+
+    def read_into(self, out, cancel=None):
+        return self._f.readinto(out)
+
+
+@pytest.fixture
+def make_raw_frames(frame_header_raw):
+    """
+    Factory for the raw data stream of `num_frames` random frames, returns
+    the raw bytes, the first frame header and the frame data
+    """
+    def _make_raw_frames(num_frames: int):
+        # pad the header like in the actual data stream:
+        header_raw = frame_header_raw.strip().encode("latin1") + b","
+        header_raw = header_raw + b'\0' * (384 - len(header_raw))
+        first_frame_header = FrameHeader.from_raw(header_raw)
+        mpx_header = b"MPX,%010d," % (len(header_raw) + SIG_SHAPE[0] * SIG_SHAPE[1] + 1)
+        data = np.random.randint(0, 64, size=(num_frames,) + SIG_SHAPE, dtype=np.uint8)
+        raw = b"".join(
+            mpx_header + header_raw + data[idx].tobytes()
+            for idx in range(num_frames)
+        )
+        return raw, first_frame_header, data
+    return _make_raw_frames
+
+
+@pytest.fixture
+def make_stream(make_raw_frames):
+    """
+    Factory for a `MerlinFrameStream` of `num_frames` random frames, returns
+    the stream and the frame data
+    """
+    def _make_stream(num_frames: int):
+        raw, first_frame_header, data = make_raw_frames(num_frames)
+        stream = MerlinFrameStream(
+            raw_socket=BytesRawSocket(raw),
+            acquisition_header=None,
+            first_frame_header=first_frame_header,
+        )
+        return stream, data
+    return _make_stream
+
+
+def make_task(start_idx: int, end_idx: int):
+    partition_slice = Slice(
+        origin=(start_idx, 0, 0),
+        shape=Shape((end_idx - start_idx,) + SIG_SHAPE, sig_dims=2),
+    )
+    return SimpleNamespace(get_partition=lambda: SimpleNamespace(slice=partition_slice))
+
+
+def put_partition(
+    queue, stream, start_idx: int, end_idx: int, tiling_depth=24, frame_chunk_size=None,
+):
+    """
+    Send the frames `start_idx:end_idx` of `stream` to `queue`, like the
+    `MerlinCommHandler` does for a task
+    """
+    handler = MerlinCommHandler(
+        conn=None,
+        state=AcqState(acq_header=None, stream=stream),
+        tiling_depth=tiling_depth,
+        frame_chunk_size=frame_chunk_size,
+    )
+    handler.handle_task(make_task(start_idx, end_idx), queue)
+
+
+def get_partition(queue, depth: int, num_frames: int, dtype=np.float32, out=None):
+    """
+    Decode a partition of `num_frames` frames from `queue` in stacks of `depth`
+    """
+    tiling_scheme = TilingScheme.make_for_shape(
+        tileshape=Shape((depth,) + SIG_SHAPE, sig_dims=2),
+        dataset_shape=Shape((num_frames,) + SIG_SHAPE, sig_dims=2),
+    )
+    return get_frames_from_queue(
+        queue, tiling_scheme, SIG_SHAPE, dtype=dtype, out=out,
+    )
+
+
+@pytest.mark.parametrize(
+    'bytes_per_frame,tiling_depth,expected', [
+        # small frames: a multiple of the tiling depth
+        (65536 + 399, 24, 24),
+        (8192 + 399, 24, 240),
+        # large frames: a divisor of the tiling depth
+        (512 * 512 * 2 + 783, 24, 3),
+        (512 * 512 * 4 + 783, 7, 1),
+        # frames larger than the target size
+        (4 * 1024 * 1024, 24, 1),
+    ],
+)
+def test_frame_chunk_size(bytes_per_frame, tiling_depth, expected):
+    assert get_frame_chunk_size(
+        bytes_per_frame=bytes_per_frame,
+        tiling_depth=tiling_depth,
+        target_bytes=2 * 1024 * 1024,
+    ) == expected
+
+
+def test_drain_after_task(make_stream):
+    # after an error in the UDF, the executor drains the messages that are
+    # left over on the request queue, and needs to understand their headers:
+    stream, data = make_stream(48)
+    queue = SimpleWorkerQueue()
+    put_partition(queue, stream, 0, 48)
+    queue.put({"type": "END_TASK"})
+    _drain_after_task(SimpleNamespace(request=queue))
+    assert queue.size() == 0
+
+
+@pytest.mark.parametrize('depth', [7, 24])
+def test_message_sizes(make_stream, depth):
+    num_frames = 100
+    stream, data = make_stream(num_frames)
+    queue = SimpleWorkerQueue()
+    put_partition(queue, stream, 0, num_frames, tiling_depth=depth)
+    frame_chunk_size = get_frame_chunk_size(
+        bytes_per_frame=stream.get_read_size(1),
+        tiling_depth=depth,
+    )
+    sizes = []
+    while queue.size() > 0:
+        with queue.get() as (header, payload):
+            if payload is not None:
+                sizes.append(len(payload))
+    # one message per chunk, and only the last one can be smaller:
+    assert sizes[:-1] == [stream.get_read_size(frame_chunk_size)] * (len(sizes) - 1)
+    assert sum(sizes) == stream.get_read_size(num_frames)
+    assert max(sizes) <= CHUNK_TARGET_BYTES
+
+
+@pytest.mark.with_numba
+@pytest.mark.parametrize(
+    'depth,frame_chunk_size', [(7, None), (24, None), (24, 3), (24, 5)],
+)
+def test_queue_roundtrip(make_stream, depth, frame_chunk_size):
+    num_frames = 64
+    stream, data = make_stream(num_frames)
+    queue = SimpleWorkerQueue()
+    put_partition(
+        queue, stream, 0, num_frames,
+        tiling_depth=depth, frame_chunk_size=frame_chunk_size,
+    )
+    result = np.zeros((num_frames,) + SIG_SHAPE, dtype=np.float32)
+    depths = []
+    for frame_stack, start_idx in get_partition(queue, depth, num_frames):
+        result[start_idx:start_idx + frame_stack.shape[0]] = frame_stack
+        depths.append(frame_stack.shape[0])
+    assert sum(depths) == num_frames
+    # chunks smaller than the tiling depth are combined into full tiles:
+    assert depths[:-1] == [depth] * (len(depths) - 1)
+    assert_allclose(result, data)
+
+
+@pytest.mark.with_numba
+def test_queue_decode_into_out(make_stream):
+    num_frames = 64
+    stream, data = make_stream(num_frames)
+    queue = SimpleWorkerQueue()
+    put_partition(queue, stream, 0, num_frames)
+    out = np.zeros((num_frames,) + SIG_SHAPE, dtype=np.float32)
+    seen = 0
+    for frame_stack, start_idx in get_partition(queue, num_frames, num_frames, out=out):
+        assert np.shares_memory(frame_stack, out)
+        seen += frame_stack.shape[0]
+    assert seen == num_frames
+    assert_allclose(out, data)
+
+
+@pytest.mark.with_numba
+def test_queue_premature_end(make_stream):
+    stream, data = make_stream(32)
+    queue = SimpleWorkerQueue()
+    with pytest.raises(JobCancelledError):
+        put_partition(queue, stream, 0, 64)
+    # END_PARTITION is sent without reserving a payload for it:
+    assert list(queue.q.queue)[-1] == ({"type": "END_PARTITION"}, None)
+
+    # we get all the data that was there, and then an END_PARTITION message:
+    seen = 0
+    for frame_stack, start_idx in get_partition(queue, 24, 64):
+        assert_allclose(frame_stack, data[start_idx:start_idx + frame_stack.shape[0]])
+        seen += frame_stack.shape[0]
+    assert seen == 32
+    assert queue.size() == 0
+
+
+class ReleaseTrackingQueue(SimpleWorkerQueue):
+    """
+    Counts the messages that were released by the consumer, and overwrites
+    their payload, like a queue that re-uses its buffers would
+    """
+    def __init__(self):
+        super().__init__()
+        self.released = 0
+
+    @contextmanager
+    def get(self, block=True, timeout=None):
+        with super().get(block=block, timeout=timeout) as msg:
+            yield msg
+        header, payload = msg
+        if payload is not None:
+            payload[:] = 0xFF
+        self.released += 1
+
+
+@pytest.mark.with_numba
+def test_queue_close_waits_for_decode(make_stream, monkeypatch):
+    num_frames = 64
+    stream, data = make_stream(num_frames)
+    queue = ReleaseTrackingQueue()
+    put_partition(queue, stream, 0, num_frames, tiling_depth=8, frame_chunk_size=8)
+
+    decode_timed = acquisition._decode_timed
+    state = {"active": 0, "released_while_decoding": 0}
+
+    def slow_decode_timed(raw_frames, out_flat):
+        released = queue.released
+        state["active"] += 1
+        try:
+            time.sleep(0.05)
+            return decode_timed(raw_frames, out_flat)
+        finally:
+            if queue.released != released:
+                state["released_while_decoding"] += 1
+            state["active"] -= 1
+
+    monkeypatch.setattr(acquisition, "_decode_timed", slow_decode_timed)
+
+    frames = get_partition(queue, 8, num_frames)
+    frame_stack, start_idx = next(frames)
+    assert_allclose(frame_stack, data[start_idx:start_idx + frame_stack.shape[0]])
+    # the next chunk is being decoded in the background while we close:
+    frames.close()
+    assert state["active"] == 0
+    assert state["released_while_decoding"] == 0
+
+
+@pytest.mark.with_numba
+def test_queue_decode_error(make_stream, monkeypatch):
+    num_frames = 64
+    stream, data = make_stream(num_frames)
+    queue = SimpleWorkerQueue()
+    put_partition(queue, stream, 0, num_frames, tiling_depth=8, frame_chunk_size=8)
+
+    decode_timed = acquisition._decode_timed
+    calls = []
+
+    def failing_decode_timed(raw_frames, out_flat):
+        calls.append(raw_frames.start_idx)
+        if len(calls) == 3:
+            raise ValueError("decode failed")
+        return decode_timed(raw_frames, out_flat)
+
+    monkeypatch.setattr(acquisition, "_decode_timed", failing_decode_timed)
+
+    seen = 0
+    with pytest.raises(ValueError, match="decode failed"):
+        for frame_stack, start_idx in get_partition(queue, 8, num_frames):
+            seen += frame_stack.shape[0]
+    # only the frames that were decoded successfully were yielded:
+    assert seen == 16
+
+
+@pytest.mark.with_numba
+@pytest.mark.parametrize('intent', ['partition', 'tile'])
+def test_partitions_no_stale_data(make_stream, intent):
+    # two partitions of different size, read with different dtypes and depths:
+    partitions = [(0, 40, np.float64, 24), (40, 64, np.float32, 7)]
+    stream, data = make_stream(64)
+    queue = SimpleWorkerQueue()
+    for start_idx, end_idx, _, depth in partitions:
+        put_partition(queue, stream, start_idx, end_idx, tiling_depth=depth)
+
+    worker_context = SimpleNamespace(get_worker_queue=lambda: queue)
+    dataset_shape = Shape((64,) + SIG_SHAPE, sig_dims=2)
+    tiles = []
+    for start_idx, end_idx, dtype, depth in partitions:
+        partition_slice = Slice(
+            origin=(start_idx, 0, 0),
+            shape=Shape((end_idx - start_idx,) + SIG_SHAPE, sig_dims=2),
+        )
+        partition = MerlinLivePartition(
+            start_idx=start_idx,
+            end_idx=end_idx,
+            partition_slice=partition_slice,
+            meta=DataSetMeta(shape=dataset_shape, raw_dtype=np.uint8, dtype=np.uint8),
+        )
+        partition.set_worker_context(worker_context)
+        tiling_scheme = TilingScheme.make_for_shape(
+            tileshape=Shape((depth,) + SIG_SHAPE, sig_dims=2),
+            dataset_shape=dataset_shape,
+            intent=intent,
+        )
+        seen = 0
+        for tile in partition.get_tiles(tiling_scheme, dest_dtype=dtype):
+            assert tile.dtype == dtype
+            tile_start = tile.tile_slice.origin[0]
+            assert_allclose(tile.data, data[tile_start:tile_start + tile.shape[0]])
+            seen += tile.shape[0]
+            tiles.append((tile_start, tile.data))
+        assert seen == end_idx - start_idx
+
+    if intent == 'partition':
+        # the tile of the first partition is not overwritten by the second:
+        for tile_start, tile in tiles:
+            assert_allclose(tile, data[tile_start:tile_start + tile.shape[0]])
+
+
+@pytest.mark.parametrize('num_slots', [1, 3])
+def test_frame_ring(make_stream, num_slots):
+    stream, data = make_stream(50)
+    ring = MerlinFrameRing(
+        stream=stream,
+        num_slots=num_slots,
+        chunk_size=8,
+        num_frames=50,
+    )
+    ring.start()
+    try:
+        seen = 0
+        while True:
+            res = ring.get()
+            if res is True or res is False:
+                break
+            raw = np.frombuffer(res.buffer, dtype=np.uint8).reshape((res.num_frames, -1))
+            assert_allclose(
+                raw[:, -SIG_SHAPE[0] * SIG_SHAPE[1]:],
+                data[res.start_idx:res.end_idx].reshape((res.num_frames, -1)),
+            )
+            seen += res.num_frames
+            ring.release()
+        assert seen == 50
+    finally:
+        ring.stop()
+        ring.join()
+
+
+def test_frame_ring_stops_between_frames(make_stream):
+    stream, data = make_stream(50)
+    ring = MerlinFrameRing(
+        stream=stream,
+        num_slots=2,
+        chunk_size=8,
+        num_frames=50,
+    )
+    raw_socket = stream._raw_socket
+    read_into = raw_socket.read_into
+
+    def read_and_stop(out, cancel=None):
+        # stop the ring in the middle of the first chunk:
+        res = read_into(out, cancel=cancel)
+        if stream._frame_counter == 2:
+            ring.stop()
+        return res
+
+    raw_socket.read_into = read_and_stop
+    ring.start()
+    ring.join(timeout=5)
+    assert not ring.is_alive()
+    # the frame that was in flight is completed, but nothing more is read:
+    assert stream._frame_counter == 3
+
+
+@pytest.mark.timeout(10)
+def test_frame_ring_stops_when_idle(make_raw_frames):
+    raw, first_frame_header, data = make_raw_frames(2)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    host, port = server.getsockname()
+    # no timeout, so reading from the idle socket blocks indefinitely:
+    raw_socket = MerlinRawSocket(host=host, port=port, timeout=None)
+    raw_socket.connect()
+    peer, _ = server.accept()
+    server.close()
+    try:
+        peer.sendall(raw)
+        stream = MerlinFrameStream(
+            raw_socket=raw_socket,
+            acquisition_header=None,
+            first_frame_header=first_frame_header,
+        )
+        ring = MerlinFrameRing(
+            stream=stream,
+            num_slots=2,
+            chunk_size=1,
+        )
+        ring.start()
+        res = ring.get()
+        assert res.start_idx == 0
+        ring.release()
+        # the ring is now waiting for the third frame, which never arrives:
+        time.sleep(0.3)
+        assert ring.is_alive()
+        assert ring.get_error() is None
+        ring.stop()
+        ring.join(timeout=3)
+        assert not ring.is_alive()
+    finally:
+        raw_socket.close()
+        peer.close()
@@ -0,0 +1,116 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from libertem_live.detectors.base.acquisition import AcquisitionTimeout
+from libertem_live.detectors.merlin.data import MerlinRawSocket
+
+
+@pytest.fixture
+def raw_socket_pair():
+    '''
+    A connected `MerlinRawSocket`, and the socket of the peer that sends data
+    '''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    host, port = server.getsockname()
+    raw_socket = MerlinRawSocket(host=host, port=port, timeout=0.1)
+    raw_socket.connect()
+    peer, _ = server.accept()
+    server.close()
+    try:
+        yield raw_socket, peer
+    finally:
+        raw_socket.close()
+        peer.close()
+
+
+def send_later(peer, data: bytes, delay: float = 0.2):
+    t = threading.Timer(delay, peer.sendall, args=(data,))
+    t.start()
+    return t
+
+
+def test_read_unbuffered_waits_for_data(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    peer.sendall(b'MPX,')
+    t = send_later(peer, b'0000000042,')
+    # the rest arrives after more than the socket timeout:
+    assert raw_socket.read_unbuffered(15) == b'MPX,0000000042,'
+    t.join()
+
+
+def test_read_unbuffered_cancel_timeout(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    peer.sendall(b'MPX,')
+    t0 = time.time()
+    with pytest.raises(AcquisitionTimeout):
+        raw_socket.read_unbuffered(15, cancel_timeout=0.3)
+    assert time.time() - t0 < 2
+
+
+def test_read_unbuffered_eof(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    peer.sendall(b'MPX,')
+    peer.close()
+    with pytest.raises(EOFError):
+        raw_socket.read_unbuffered(15)
+
+
+def test_peek_waits_for_rest(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    peer.sendall(b'MPX,')
+    t = send_later(peer, b'0000000042,')
+    assert raw_socket._peek(15) == b'MPX,0000000042,'
+    t.join()
+    # peeking doesn't consume the data:
+    assert raw_socket.read_unbuffered(15) == b'MPX,0000000042,'
+
+
+def test_peek_eof(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    peer.close()
+    with pytest.raises(EOFError):
+        raw_socket._peek(15)
+
+
+@pytest.mark.timeout(10)
+def test_drain_stops_at_eof(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    data = b'x' * (3 * 1024 * 1024 + 17)
+
+    def send_and_close():
+        peer.sendall(data)
+        peer.close()
+
+    t = threading.Thread(target=send_and_close)
+    t.start()
+    assert raw_socket.drain() == len(data)
+    t.join()
+
+
+@pytest.mark.timeout(10)
+def test_drain_stops_when_idle(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    peer.sendall(b'x' * 1234)
+    # the peer stays connected, but doesn't send anything more:
+    assert raw_socket.drain() == 1234
+
+
+@pytest.mark.timeout(10)
+def test_read_into_cancel(raw_socket_pair):
+    raw_socket, peer = raw_socket_pair
+    # wait for data indefinitely, unless cancelled:
+    raw_socket._timeout = None
+    peer.sendall(b'MPX,')
+    cancelled = threading.Event()
+    t = threading.Timer(0.3, cancelled.set)
+    t.start()
+    buf = bytearray(15)
+    # no more data arrives, but the read returns once it is cancelled:
+    assert raw_socket.read_into(buf, cancel=cancelled.is_set) == 4
+    assert bytes(buf[:4]) == b'MPX,'
+    t.join()